@@ -0,0 +1,80 @@
+import datetime as dt
+import math
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS_M = 6371000.0
+
+
+class Detection(NamedTuple):
+    label_id: int
+    image_id: int
+    sighting_id: Optional[int]
+    latitude: float
+    longitude: float
+    timestamp: dt.datetime
+    confidence: float
+
+
+def cluster_detections(detections: List[Detection], distance_m: float, time_window_s: float) -> np.ndarray:
+    # complete linkage: all members of a cluster are within distance_m and time_window_s of each other,
+    # so a flight line of overlapping frames can't chain into one sighting
+    count = len(detections)
+    latitude = np.array([d.latitude for d in detections])
+    longitude = np.array([d.longitude for d in detections])
+    start = min(d.timestamp for d in detections)
+    seconds = np.array([(d.timestamp - start).total_seconds() for d in detections])
+
+    # local equirectangular projection is accurate enough within a search area
+    x = EARTH_RADIUS_M * np.radians(longitude - longitude.mean()) * math.cos(math.radians(latitude.mean()))
+    y = EARTH_RADIUS_M * np.radians(latitude - latitude.mean())
+
+    points = np.column_stack([x / distance_m, y / distance_m, seconds / time_window_s])
+    neighbors = cKDTree(points).query_ball_point(points, r=1.0, p=np.inf)
+
+    clusters = np.full(count, -1)
+    members: List[List[int]] = []
+    images: List[Set[int]] = []
+
+    def add(i: int, cluster: int):
+        clusters[i] = cluster
+        members[cluster].append(i)
+        images[cluster].add(detections[i].image_id)
+
+    # members of an existing sighting always stay together
+    existing: Dict[int, int] = {}
+    for i, d in enumerate(detections):
+        if d.sighting_id is not None:
+            if d.sighting_id not in existing:
+                existing[d.sighting_id] = len(members)
+                members.append([])
+                images.append(set())
+            add(i, existing[d.sighting_id])
+
+    for i in np.argsort(seconds, kind='stable'):
+        if clusters[i] >= 0:
+            continue
+
+        # the tree returns neighbors within a box, keep only those within the distance
+        linked: Dict[int, int] = {}
+        for j in neighbors[i]:
+            if clusters[j] >= 0 and math.hypot(x[i] - x[j], y[i] - y[j]) <= distance_m:
+                linked[clusters[j]] = linked.get(clusters[j], 0) + 1
+
+        # labels of one image share its GPS position but are different people
+        candidates = [cluster for cluster, linked_count in linked.items()
+                      if linked_count == len(members[cluster]) and detections[i].image_id not in images[cluster]]
+
+        if candidates:
+            cluster = min(candidates, key=lambda c: math.hypot(x[members[c]].mean() - x[i],
+                                                                 y[members[c]].mean() - y[i]))
+        else:
+            cluster = len(members)
+            members.append([])
+            images.append(set())
+        add(i, cluster)
+
+    return clusters
@@ -1,14 +1,25 @@
 ﻿import argparse
+import collections
+import itertools
 import json
 import logging
+import math
+import multiprocessing
+import queue
 import sys
 import textwrap
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, NamedTuple, Optional
+from typing import List, NamedTuple, Optional, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 import ultralytics
+from PIL import Image
 
+import resolution
+import runtime
 import utils
 
 
@@ -25,6 +36,19 @@ class ProgramOptions(NamedTuple):
     iou: float
     image_size: int
     device: Optional[str]
+    max_det: int = 300
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    replicas: int = 1
+    decode_workers: int = 2
+    pin_cores: bool = False
+    adaptive_size: bool = False
+    sizes: Sequence[int] = (640, 960, 1280, 1600, 1920, 2560)
+    person_size: float = 1.0
+    person_pixels: int = 32
+    focal_length: float = 24.0
+    ground_altitude: float = 0.0
+    batch_size: int = 1
 
 
 class Label(NamedTuple):
@@ -39,7 +63,27 @@ class Label(NamedTuple):
 
 class Times(NamedTuple):
     image: str
-    total: float
+    total: float  # decoding and inference
+    inference: float
+    image_size: int
+
+
+class Chunk(NamedTuple):
+    paths: List[Path]
+    image_size: int
+
+
+class ChunkResult(NamedTuple):
+    labels: List[Label]
+    times: List[Times]
+    start: float  # wall clock time, comparable between replica processes
+    end: float
+
+
+CHUNK_SIZE = 8
+
+_replica_model = None
+_replica_options: Optional[ProgramOptions] = None
 
 
 def show_progress(stopwatch: utils.Stopwatch, processed_images: int, total_images: int, detected_persons: int):
@@ -54,6 +98,101 @@ def show_progress(stopwatch: utils.Stopwatch, processed_images: int, total_image
                 utils.remaining_time(stopwatch, processed_images, total_images, seconds_rounding=int)))
 
 
+def get_runtime_config(options: ProgramOptions) -> runtime.RuntimeConfig:
+    return runtime.RuntimeConfig(
+        intra_op_threads=options.intra_op_threads,
+        inter_op_threads=options.inter_op_threads,
+        replicas=options.replicas,
+        decode_workers=options.decode_workers,
+        pin_cores=options.pin_cores)
+
+
+def init_replica(options: ProgramOptions, core_sets):
+    global _replica_model, _replica_options
+
+    config = get_runtime_config(options)
+    cores = core_sets.get()
+    if config.pin_cores and not runtime.pin_process(cores):
+        LOGGER.warning('Core pinning is not supported on this platform')
+    runtime.configure_torch(config, cores)
+
+    _replica_options = options
+    _replica_model = ultralytics.YOLO(options.model_path)
+
+
+def read_image_timed(path: Path) -> Tuple[np.ndarray, float]:
+    # labels.csv keeps the frame of earlier runs, when ultralytics read the path and applied EXIF orientation
+    stopwatch = utils.Stopwatch()
+    image = utils.read_image(path, ignore_orientation=False)
+    return image, stopwatch.elapsed_seconds()
+
+
+def predict_chunk(chunk: Chunk) -> ChunkResult:
+    assert _replica_model is not None and _replica_options is not None
+    options = _replica_options
+
+    start = time.time()
+    labels: List[Label] = []
+    times: List[Times] = []
+
+    # decode workers read the next images while the model processes the current batch
+    with ThreadPoolExecutor(options.decode_workers) as executor:
+        images = utils.bounded_map(executor, read_image_timed, chunk.paths,
+                                   options.batch_size + options.decode_workers)
+        for batch_start in range(0, len(chunk.paths), options.batch_size):
+            batch_paths = chunk.paths[batch_start:batch_start + options.batch_size]
+            batch = list(itertools.islice(images, len(batch_paths)))
+
+            batch_stopwatch = utils.Stopwatch()
+            results = _replica_model.predict(source=[image for image, _ in batch], conf=options.confidence,
+                                             iou=options.iou, imgsz=chunk.image_size, device=options.device,
+                                             classes=0, max_det=options.max_det, verbose=False)
+            inference_seconds = batch_stopwatch.elapsed_seconds() / len(batch_paths)
+
+            for path, (_, decode_seconds), result in zip(batch_paths, batch, results):
+                relative_path = path.relative_to(options.images_dir).as_posix()
+
+                times.append(Times(
+                    image=relative_path,
+                    total=decode_seconds + inference_seconds,
+                    inference=inference_seconds,
+                    image_size=chunk.image_size))
+
+                for ((xc, yc, w, h), conf) in zip(result.boxes.xywhn.tolist(), result.boxes.conf.tolist()):
+                    labels.append(Label(image=relative_path, label=0,
+                                        xc=xc, yc=yc, w=w, h=h, score=conf))
+
+    return ChunkResult(labels, times, start, time.time())
+
+
+def select_image_sizes(options: ProgramOptions, images: List[Path]) -> List[int]:
+    if not options.adaptive_size:
+        return [options.image_size] * len(images)
+
+    config = resolution.AdaptiveSizeConfig(
+        sizes=list(options.sizes),
+        person_size_m=options.person_size,
+        person_pixels=options.person_pixels,
+        focal_length_35mm=options.focal_length,
+        ground_altitude_m=options.ground_altitude)
+
+    image_sizes = []
+    for path in images:
+        with Image.open(path) as image:  # reads only the header
+            image_sizes.append(resolution.select_image_size(image, config, options.image_size))
+    return image_sizes
+
+
+def split_into_chunks(images: List[Path], image_sizes: List[int], batch_size: int) -> List[Chunk]:
+    # images of the same size are grouped, so that they can be processed in batches
+    chunk_size = math.ceil(CHUNK_SIZE / batch_size) * batch_size
+    chunks = []
+    for image_size, group in itertools.groupby(sorted(zip(image_sizes, images)), key=lambda item: item[0]):
+        paths = [path for _, path in group]
+        chunks.extend(Chunk(paths[i:i + chunk_size], image_size) for i in range(0, len(paths), chunk_size))
+    return chunks
+
+
 def predict(options: ProgramOptions):
     LOGGER.info('Enumerate images...')
     images = sorted(utils.enum_images(options.images_dir))
@@ -65,6 +204,8 @@ def predict(options: ProgramOptions):
         '\n'.join(image.relative_to(options.images_dir).as_posix() for image in images),
         encoding='utf-8')
 
+    config = get_runtime_config(options)
+
     metadata = {
         'task': 'detect',
         'mode': 'predict',
@@ -76,51 +217,110 @@ def predict(options: ProgramOptions):
             'confidence': options.confidence,
             'iou': options.iou,
             'image_size': options.image_size,
+            'max_det': options.max_det,
             },
         'device': options.device,
+        'runtime': config._asdict(),
+        'adaptive_size': {
+            'enabled': options.adaptive_size,
+            'sizes': list(options.sizes),
+            'person_size': options.person_size,
+            'person_pixels': options.person_pixels,
+            'focal_length': options.focal_length,
+            'ground_altitude': options.ground_altitude,
+            },
+        'batch_size': options.batch_size,
         }
 
-    LOGGER.info('Save metadata to "experiment.json"...')
-    (options.output_dir / 'experiment.json').write_text(
-        json.dumps(metadata, indent=4), encoding='utf-8')
+    def save_metadata():
+        LOGGER.info('Save metadata to "experiment.json"...')
+        (options.output_dir / 'experiment.json').write_text(
+            json.dumps(metadata, indent=4), encoding='utf-8')
+
+    save_metadata()
 
     labels: List[Label] = []
     times: List[Times] = []
 
-    LOGGER.info('Load model...')
-    model = ultralytics.YOLO(options.model_path)
+    core_sets = runtime.partition_cores(runtime.available_cores(), config.replicas)
+
+    LOGGER.info('Select image sizes...')
+    image_sizes = select_image_sizes(options, images)
+    chunks = split_into_chunks(images, image_sizes, options.batch_size)
 
+    monitor = runtime.UtilizationMonitor()
     stopwatch = utils.Stopwatch()
     person_count = 0
-
-    for image_num, path in enumerate(images):
-        LOGGER.info(f'Process image: {path}')
-
-        relative_path = path.relative_to(options.images_dir).as_posix()
-
-        image_stopwatch = utils.Stopwatch()
-        results = model.predict(source=path, conf=options.confidence, iou=options.iou, imgsz=options.image_size,
-                                device=options.device, classes=0, verbose=False)
-
-        times.append(Times(
-            image=relative_path,
-            total=image_stopwatch.elapsed_seconds()))
-
-        for result in results:
-            for ((xc, yc, w, h), conf) in zip(result.boxes.xywhn.tolist(), result.boxes.conf.tolist()):
-                labels.append(Label(image=relative_path, label=0,
-                                    xc=xc, yc=yc, w=w, h=h, score=conf))
-                LOGGER.debug(f'Detected: box=[{xc:.4f}, {yc:.4f}, {w:.4f}, {h:.4f}] conf={conf:.4f}')
-                person_count += 1
-
-        show_progress(stopwatch, image_num + 1, len(images), person_count)
+    processing_start, processing_end = math.inf, -math.inf
+
+    def collect(result: ChunkResult):
+        nonlocal person_count, processing_start, processing_end
+
+        for image_times in result.times:
+            LOGGER.info(f'Processed image: {image_times.image} ({image_times.total:.2f} s)')
+        for label in result.labels:
+            LOGGER.debug(f'Detected: image={label.image} box=[{label.xc:.4f}, {label.yc:.4f}, '
+                         f'{label.w:.4f}, {label.h:.4f}] conf={label.score:.4f}')
+
+        labels.extend(result.labels)
+        times.extend(result.times)
+        person_count += len(result.labels)
+        processing_start = min(processing_start, result.start)
+        processing_end = max(processing_end, result.end)
+        show_progress(stopwatch, len(times), len(images), person_count)
+
+    if config.replicas == 1:
+        LOGGER.info('Load model...')
+        local_core_sets: queue.Queue = queue.Queue()
+        local_core_sets.put(core_sets[0])
+        init_replica(options, local_core_sets)
+
+        for chunk in chunks:
+            collect(predict_chunk(chunk))
+    else:
+        LOGGER.info(f'Start {config.replicas} model replicas...')
+        process_core_sets = multiprocessing.Queue()
+        for cores in core_sets:
+            process_core_sets.put(cores)
+
+        with ProcessPoolExecutor(config.replicas, initializer=init_replica,
+                                 initargs=(options, process_core_sets)) as executor:
+            for result in executor.map(predict_chunk, chunks):
+                collect(result)
+
+    LOGGER.info('Runtime report:\n' + textwrap.indent(
+        runtime.format_report(config, core_sets, monitor.stop()), '  '))
+
+    # replicas process images concurrently, so per-image times don't add up to the elapsed time;
+    # the processing window starts with the first chunk, after a model has been loaded
+    processing_seconds = max(processing_end - processing_start, 0.0) if times else 0.0
+    metadata['throughput'] = {
+        'processing_seconds': processing_seconds,
+        'images_per_second': len(times) / processing_seconds if processing_seconds > 0 else 0.0,
+        }
+    LOGGER.info(f'Throughput: {metadata["throughput"]["images_per_second"]:.2f} images/s')
+    save_metadata()
+
+    if options.adaptive_size:
+        size_counts = collections.Counter(image_sizes)
+        compute = resolution.relative_compute(image_sizes, options.image_size)
+        LOGGER.info('Adaptive image sizes: ' + ', '.join(
+            f'{size}: {count}' for size, count in sorted(size_counts.items())))
+        LOGGER.info(f'Estimated compute relative to fixed size {options.image_size}: {compute * 100:.0f}% '
+                    f'(saved {(1 - compute) * 100:.0f}%)')
+
+    # chunks are grouped by image size, restore the order of images
+    image_order = {image.relative_to(options.images_dir).as_posix(): i for i, image in enumerate(images)}
+    labels.sort(key=lambda label: image_order[label.image])
+    times.sort(key=lambda image_times: image_order[image_times.image])
 
     LOGGER.info('Save labels to "labels.csv"...')
     columns = ['image', 'label', 'xc', 'yc', 'w', 'h', 'score']
     pd.DataFrame(labels, columns=columns).to_csv(options.output_dir / 'labels.csv', index=False)
 
     LOGGER.info('Save processing times to "times.csv"...')
-    pd.DataFrame(times, columns=['image', 'total']).to_csv(options.output_dir / 'times.csv', index=False)
+    pd.DataFrame(times, columns=['image', 'total', 'inference', 'image_size']).to_csv(
+        options.output_dir / 'times.csv', index=False)
 
 
 def configure_logging(logger: logging.Logger, output_path: Path):
@@ -159,13 +359,57 @@ def parse_command_line_options() -> ProgramOptions:
     parser.add_argument('--device', dest='device', type=str,
                         help='device to run on, i.e. device=cuda or device=0,1,2,3 or device=cpu')
 
+    parser.add_argument('--max-det', dest='max_det', type=int,
+                        help='maximum number of detections per image (default: %(default)s)')
+
+    parser.add_argument('--intra-op-threads', dest='intra_op_threads', type=int,
+                        help='torch intra-op threads per replica, 0 - one per core of the replica (default: %(default)s)')
+
+    parser.add_argument('--inter-op-threads', dest='inter_op_threads', type=int,
+                        help='torch inter-op threads per replica, 0 - torch default (default: %(default)s)')
+
+    parser.add_argument('--replicas', dest='replicas', type=int,
+                        help='number of model replicas, each in its own process (default: %(default)s)')
+
+    parser.add_argument('--decode-workers', dest='decode_workers', type=int,
+                        help='number of image decoding threads per replica (default: %(default)s)')
+
+    parser.add_argument('--pin-cores', dest='pin_cores', action='store_true',
+                        help='pin each replica to its own subset of cores')
+
+    parser.add_argument('--adaptive-size', dest='adaptive_size', action='store_true',
+                        help='select the size of each input image from the altitude in EXIF/XMP, '
+                             '--image-size is used for images without altitude')
+
+    parser.add_argument('--sizes', dest='sizes', type=int, nargs='+',
+                        help='input image sizes for the adaptive mode (default: %(default)s)')
+
+    parser.add_argument('--person-size', dest='person_size', type=float,
+                        help='expected person size on the ground in meters (default: %(default)s)')
+
+    parser.add_argument('--person-pixels', dest='person_pixels', type=int,
+                        help='desired person size in pixels of the model input (default: %(default)s)')
+
+    parser.add_argument('--focal-length', dest='focal_length', type=float,
+                        help='35 mm equivalent focal length for images without it in EXIF (default: %(default)s)')
+
+    parser.add_argument('--ground-altitude', dest='ground_altitude', type=float,
+                        help='ground altitude above sea level in meters, '
+                             'used when only GPS altitude is known (default: %(default)s)')
+
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        help='number of images of the same size processed together (default: %(default)s)')
+
     parser.add_argument('images_dir', type=Path,
                         help='path to the input directory with images')
 
     parser.add_argument('output_dir', type=Path,
                         help='path to the output directory')
 
-    parser.set_defaults(confidence=0.1, iou=0.1, image_size=1280, model_path='yolov8x.pt')
+    parser.set_defaults(confidence=0.1, iou=0.1, image_size=1280, model_path='yolov8x.pt', max_det=300,
+                        intra_op_threads=0, inter_op_threads=0, replicas=1, decode_workers=2,
+                        sizes=[640, 960, 1280, 1600, 1920, 2560], person_size=1.0, person_pixels=32,
+                        focal_length=24.0, ground_altitude=0.0, batch_size=1)
 
     args = parser.parse_args()
 
@@ -175,6 +419,13 @@ def parse_command_line_options() -> ProgramOptions:
     if not args.images_dir.exists():
         parser.error(f'argument images_dir: path "{args.images_dir}" not found')
 
+    for name in ['max_det', 'replicas', 'decode_workers', 'batch_size']:
+        if getattr(args, name) < 1:
+            parser.error(f'argument --{name.replace("_", "-")}: must be positive')
+
+    if any(size < 1 for size in args.sizes):
+        parser.error('argument --sizes: must be positive')
+
     return ProgramOptions(**vars(args))
 
 
@@ -0,0 +1,251 @@
+﻿import argparse
+import json
+import logging
+import textwrap
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+import torchvision
+from PIL import Image
+
+import detect_yolo8
+import utils
+from metrics import compute_metrics, match_predictions, pareto_optimal, xywhn_to_xyxy
+
+
+LOGGER = logging.getLogger('evaluate_yolo8')
+
+# raw predictions are cached with almost no NMS, the grid NMS is applied afterwards
+RAW_NMS_IOU = 0.95
+# and without the default limit of 300 boxes per image
+RAW_MAX_DET = 10000
+
+
+class ProgramOptions(NamedTuple):
+    images_dir: Path
+    labels_dir: Path
+    output_dir: Path
+    model_path: Path
+    image_sizes: List[int]
+    confidences: List[float]
+    ious: List[float]
+    match_ious: List[float]
+    device: Optional[str]
+
+
+def get_image_sizes(images_dir: Path, images: List[str]) -> Dict[str, Tuple[int, int]]:
+    sizes = {}
+    for image in images:
+        with Image.open(images_dir / image) as data:  # reads only the header
+            sizes[image] = data.size
+    return sizes
+
+
+def load_ground_truth(options: ProgramOptions, image_sizes: Dict[str, Tuple[int, int]]) -> Dict[str, np.ndarray]:
+    ground_truth = {}
+    for image, (width, height) in image_sizes.items():
+        path = options.labels_dir / Path(image).with_suffix('.txt')
+        boxes = np.zeros((0, 4))
+        if path.exists():
+            values = np.loadtxt(path, ndmin=2)
+            if values.size > 0:
+                boxes = xywhn_to_xyxy(values[:, 1:5], width, height)
+        ground_truth[image] = boxes
+    return ground_truth
+
+
+def cache_predictions(options: ProgramOptions, images: List[str], image_size: int) -> Path:
+    cache_dir = options.output_dir / 'predictions' / f'size-{image_size}'
+    confidence = min(options.confidences)
+
+    detect_options = detect_yolo8.ProgramOptions(
+        images_dir=options.images_dir,
+        output_dir=cache_dir,
+        model_path=options.model_path,
+        confidence=confidence,
+        iou=RAW_NMS_IOU,
+        image_size=image_size,
+        device=options.device,
+        max_det=RAW_MAX_DET)
+
+    metadata_path = cache_dir / 'experiment.json'
+    images_path = cache_dir / 'images.txt'
+    if (cache_dir / 'labels.csv').exists() and metadata_path.exists() and images_path.exists():
+        metadata = json.loads(metadata_path.read_text(encoding='utf-8'))
+        parameters = metadata['model_parameters']
+        # the image list is compared too, the directory may have changed since the predictions were cached;
+        # device and runtime are part of the key because the cached throughput is reported as the speed
+        if (metadata['model_path'] == str(options.model_path)
+                and metadata['images_dir'] == str(options.images_dir)
+                and sorted(images_path.read_text(encoding='utf-8').splitlines()) == images
+                and parameters['image_size'] == image_size
+                and parameters['iou'] == RAW_NMS_IOU
+                and parameters.get('max_det') == RAW_MAX_DET
+                and parameters['confidence'] <= confidence
+                and metadata['device'] == options.device
+                and metadata.get('runtime') == detect_yolo8.get_runtime_config(detect_options)._asdict()
+                and metadata.get('batch_size') == detect_options.batch_size
+                and 'throughput' in metadata):
+            LOGGER.info(f'Use cached predictions: {cache_dir}')
+            return cache_dir
+
+    LOGGER.info(f'Predict with image size {image_size}...')
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    detect_yolo8.predict(detect_options)
+
+    return cache_dir
+
+
+def apply_nms(predictions: pd.DataFrame, image_sizes: Dict[str, Tuple[int, int]], iou: float) -> pd.DataFrame:
+    if predictions.empty:
+        return predictions
+
+    widths = predictions['image'].map(lambda image: image_sizes[image][0]).to_numpy()
+    heights = predictions['image'].map(lambda image: image_sizes[image][1]).to_numpy()
+    boxes = xywhn_to_xyxy(predictions[['xc', 'yc', 'w', 'h']].to_numpy(), widths, heights)
+    image_codes, _ = pd.factorize(predictions['image'])
+
+    # one batched call for the whole dataset, boxes of different images never suppress each other
+    keep = torchvision.ops.batched_nms(
+        torch.from_numpy(boxes), torch.from_numpy(predictions['score'].to_numpy()),
+        torch.from_numpy(image_codes), iou)
+
+    keep = np.sort(keep.numpy())
+    result = predictions.iloc[keep].copy()
+    result[['xmin', 'ymin', 'xmax', 'ymax']] = boxes[keep]
+    return result
+
+
+def evaluate(options: ProgramOptions):
+    options.output_dir.mkdir(parents=True, exist_ok=True)
+
+    images = sorted(path.relative_to(options.images_dir).as_posix()
+                    for path in utils.enum_images(options.images_dir))
+    LOGGER.info(f'Image count: {len(images)}')
+
+    image_sizes = get_image_sizes(options.images_dir, images)
+    ground_truth = load_ground_truth(options, image_sizes)
+    LOGGER.info(f'Ground truth objects: {sum(len(boxes) for boxes in ground_truth.values())}')
+
+    rows = []
+    for image_size in options.image_sizes:
+        cache_dir = cache_predictions(options, images, image_size)
+        predictions = pd.read_csv(cache_dir / 'labels.csv')
+        metadata = json.loads((cache_dir / 'experiment.json').read_text(encoding='utf-8'))
+        speed = metadata['throughput']['images_per_second']
+
+        for iou in options.ious:
+            matched = match_predictions(apply_nms(predictions, image_sizes, iou), ground_truth, options.match_ious)
+
+            for confidence in options.confidences:
+                precision, recall, average_precision = compute_metrics(matched, confidence)
+                row = {'image_size': image_size, 'confidence': confidence, 'iou': iou}
+                for k, match_iou in enumerate(options.match_ious):
+                    row[f'precision@{match_iou}'] = precision[k]
+                    row[f'recall@{match_iou}'] = recall[k]
+                    row[f'AP@{match_iou}'] = average_precision[k]
+                row['mAP'] = average_precision.mean()
+                row['images/s'] = speed
+                rows.append(row)
+
+    results = pd.DataFrame(rows)
+    primary_recall = f'recall@{options.match_ious[0]}'
+    results['pareto'] = pareto_optimal(results[primary_recall].to_numpy(), results['images/s'].to_numpy())
+    results = results.sort_values([primary_recall, 'images/s'], ascending=False)
+
+    LOGGER.info('Save results to "evaluation.csv"...')
+    results.to_csv(options.output_dir / 'evaluation.csv', index=False)
+
+    pareto = results[results['pareto']].drop(columns='pareto')
+    LOGGER.info(f'Pareto front of {primary_recall} vs images/s:\n' + textwrap.indent(
+        pareto.to_string(index=False, float_format='{:.3f}'.format), '  '))
+
+
+def configure_logging(logger: logging.Logger, output_path: Path):
+    formatter = logging.Formatter('%(asctime)s [%(levelname)5s] %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.INFO)
+    logger.addHandler(stream_handler)
+
+    file_handler = logging.FileHandler(output_path, 'wt', encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+
+    logger.setLevel(1) # min level
+
+
+def parse_command_line_options() -> ProgramOptions:
+    parser = argparse.ArgumentParser(
+        description='Evaluate YOLOv8 human detection over a grid of parameters.',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--model', dest='model_path', type=Path,
+                        help='path to the model (default: %(default)s)')
+
+    parser.add_argument('--image-sizes', dest='image_sizes', type=int, nargs='+',
+                        help='sizes of input images (default: %(default)s)')
+
+    parser.add_argument('--confidences', dest='confidences', type=float, nargs='+',
+                        help='confidence tresholds (default: %(default)s)')
+
+    parser.add_argument('--ious', dest='ious', type=float, nargs='+',
+                        help='IoU thresholds for NMS (default: %(default)s)')
+
+    parser.add_argument('--match-ious', dest='match_ious', type=float, nargs='+',
+                        help='IoU thresholds for matching with ground truth, '
+                             'the first one is used for the Pareto table (default: %(default)s)')
+
+    parser.add_argument('--device', dest='device', type=str,
+                        help='device to run on, i.e. device=cuda or device=0,1,2,3 or device=cpu')
+
+    parser.add_argument('images_dir', type=Path,
+                        help='path to the input directory with images')
+
+    parser.add_argument('labels_dir', type=Path,
+                        help='path to the directory with ground truth labels in YOLO format')
+
+    parser.add_argument('output_dir', type=Path,
+                        help='path to the output directory')
+
+    parser.set_defaults(image_sizes=[1280], confidences=[0.05, 0.1, 0.25], ious=[0.1, 0.3, 0.5],
+                        match_ious=[0.3, 0.5], model_path='yolov8x.pt')
+
+    args = parser.parse_args()
+
+    if not args.model_path.exists() and args.model_path.is_absolute():
+        parser.error(f'argument --model: path "{args.model_path}" not found')
+
+    if not args.images_dir.exists():
+        parser.error(f'argument images_dir: path "{args.images_dir}" not found')
+
+    if not args.labels_dir.exists():
+        parser.error(f'argument labels_dir: path "{args.labels_dir}" not found')
+
+    if max(args.ious) > RAW_NMS_IOU:
+        parser.error(f'argument --ious: values must not exceed {RAW_NMS_IOU}')
+
+    return ProgramOptions(**vars(args))
+
+
+def main():
+    options = parse_command_line_options()
+
+    options.output_dir.mkdir(exist_ok=True, parents=True)
+
+    configure_logging(LOGGER, options.output_dir / 'evaluate.log')
+    configure_logging(detect_yolo8.LOGGER, options.output_dir / 'detect.log')
+
+    LOGGER.info('Program options:\n' + textwrap.indent(
+        '\n'.join(f'{name} = {options[i]}' for i, name in enumerate(options._fields)), '  '))
+
+    evaluate(options)
+
+
+if __name__ == '__main__':
+    main()
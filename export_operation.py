@@ -0,0 +1,378 @@
+﻿import argparse
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import textwrap
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from PIL import Image, ImageDraw
+from peewee import JOIN
+
+import storage
+import utils
+
+
+LOGGER = logging.getLogger('export_operation')
+
+EXPORT_FORMATS = ['geojson', 'kml', 'csv', 'parquet', 'crops']
+
+
+class ProgramOptions(NamedTuple):
+    output_dir: Path
+    upload_ids: Optional[List[int]]
+    rescue_operation: Optional[str]
+    formats: List[str]
+    min_confidence: float
+    crop_size: int
+    workers: int
+
+
+class ExportRow(NamedTuple):
+    upload_id: int
+    rescue_operation: str
+    image_id: int
+    image_path: str
+    original_name: str
+    timestamp: Optional[str]
+    latitude: Optional[float]
+    longitude: Optional[float]
+    original_width: Optional[int]
+    label_id: int
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
+    confidence: float
+
+
+class CropTask(NamedTuple):
+    image_path: Path
+    original_width: Optional[int]
+    rows: List[ExportRow]
+    crop_size: int
+
+
+class CropResult(NamedTuple):
+    image_path: Path
+    crops: List[Tuple[str, bytes]]
+    error: Optional[str]
+
+
+LABEL_COLUMNS = ['upload_id', 'rescue_operation', 'image_id', 'original_name', 'timestamp', 'latitude', 'longitude',
+                 'label_id', 'xmin', 'ymin', 'xmax', 'ymax', 'confidence']
+
+
+def query_rows(options: ProgramOptions) -> Iterator[ExportRow]:
+    query = (storage.Label
+             .select(storage.Upload.id.alias('upload_id'),
+                     storage.Upload.rescue_operation,
+                     storage.Image.id.alias('image_id'),
+                     storage.Image.path.alias('image_path'),
+                     storage.Image.original_name,
+                     storage.Image.timestamp,
+                     storage.Image.latitude,
+                     storage.Image.longitude,
+                     storage.ArchivedImage.width.alias('original_width'),
+                     storage.Label.id.alias('label_id'),
+                     storage.Label.xmin,
+                     storage.Label.ymin,
+                     storage.Label.xmax,
+                     storage.Label.ymax,
+                     storage.Label.confidence)
+             .join(storage.Image)
+             .join(storage.Upload)
+             .switch(storage.Image)
+             .join(storage.ArchivedImage, JOIN.LEFT_OUTER)
+             .where(storage.Label.confidence >= options.min_confidence))
+
+    if options.upload_ids:
+        query = query.where(storage.Upload.id.in_(options.upload_ids))
+    if options.rescue_operation is not None:
+        query = query.where(storage.Upload.rescue_operation == options.rescue_operation)
+
+    # iterator() streams rows from the cursor without caching the whole result
+    for row in query.order_by(storage.Image.id, storage.Label.id).tuples().iterator():
+        timestamp = row[5].isoformat(sep=' ') if row[5] is not None else None
+        yield ExportRow(*row[:5], timestamp, *row[6:])
+
+
+def label_values(row: ExportRow) -> list:
+    return [getattr(row, column) for column in LABEL_COLUMNS]
+
+
+class CsvWriter:
+
+    def __init__(self, path: Path):
+        self.file = path.open('wt', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(LABEL_COLUMNS)
+
+    def write(self, row: ExportRow):
+        self.writer.writerow(label_values(row))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, path: Path, batch_size: int = 10000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ('upload_id', pa.int64()),
+            ('rescue_operation', pa.string()),
+            ('image_id', pa.int64()),
+            ('original_name', pa.string()),
+            ('timestamp', pa.string()),
+            ('latitude', pa.float64()),
+            ('longitude', pa.float64()),
+            ('label_id', pa.int64()),
+            ('xmin', pa.float64()),
+            ('ymin', pa.float64()),
+            ('xmax', pa.float64()),
+            ('ymax', pa.float64()),
+            ('confidence', pa.float64()),
+            ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch_size = batch_size
+        self.batch: List[ExportRow] = []
+
+    def write(self, row: ExportRow):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        columns = {column: [getattr(row, column) for row in self.batch] for column in LABEL_COLUMNS}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class GeoJsonWriter:
+
+    def __init__(self, path: Path):
+        self.file = path.open('wt', encoding='utf-8')
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.first = True
+
+    def write(self, row: ExportRow):
+        if row.latitude is None:
+            return
+
+        feature = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [row.longitude, row.latitude]},
+            'properties': {column: getattr(row, column) for column in LABEL_COLUMNS
+                           if column not in ('latitude', 'longitude')},
+        }
+        if not self.first:
+            self.file.write(',\n')
+        self.file.write(json.dumps(feature, ensure_ascii=False))
+        self.first = False
+
+    def close(self):
+        self.file.write('\n]}\n')
+        self.file.close()
+
+
+class KmlWriter:
+
+    def __init__(self, path: Path):
+        self.file = path.open('wt', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+
+    def write(self, row: ExportRow):
+        if row.latitude is None:
+            return
+
+        description = f'{row.rescue_operation} | {row.timestamp or ""} | confidence: {row.confidence:.2f}'
+        self.file.write(
+            '<Placemark>'
+            f'<name>{escape(row.original_name)} #{row.label_id}</name>'
+            f'<description>{escape(description)}</description>'
+            f'<Point><coordinates>{row.longitude},{row.latitude}</coordinates></Point>'
+            '</Placemark>\n')
+
+    def close(self):
+        self.file.write('</Document>\n</kml>\n')
+        self.file.close()
+
+
+def crop_image(task: CropTask) -> CropResult:
+    try:
+        return CropResult(task.image_path, crop_labels(task), None)
+    except OSError as e:
+        # a missing or broken image must not abort the export, the error is logged by the main process
+        return CropResult(task.image_path, [], str(e))
+
+
+def crop_labels(task: CropTask) -> List[Tuple[str, bytes]]:
+    crops = []
+    font = utils.load_font(15)
+
+    with Image.open(task.image_path) as image:
+        scale = image.size[0] / task.original_width if task.original_width else 1.0
+
+        for row in task.rows:
+            xc = (row.xmin + row.xmax) / 2 * scale
+            yc = (row.ymin + row.ymax) / 2 * scale
+            patch = utils.crop_patch(image, xc, yc, task.crop_size * scale).convert('RGB')
+            if scale != 1.0:
+                patch = patch.resize((task.crop_size, task.crop_size))
+
+            left = xc / scale - task.crop_size / 2
+            top = yc / scale - task.crop_size / 2
+            draw = ImageDraw.Draw(patch)
+            draw.rectangle(((row.xmin - left, row.ymin - top), (row.xmax - left, row.ymax - top)),
+                           width=2, outline='red')
+            draw.text((task.crop_size - 3, task.crop_size - 3), f'{row.confidence:.2f}',
+                      fill=(255,255,255), font=font, anchor='rb')
+
+            buffer = io.BytesIO()
+            patch.save(buffer, format='JPEG', quality=90)
+            name = f'{row.upload_id}/{Path(row.original_name).stem}_{row.label_id}.jpg'
+            crops.append((name, buffer.getvalue()))
+
+    return crops
+
+
+def export(options: ProgramOptions):
+    writer_types = {
+        'geojson': (GeoJsonWriter, 'detections.geojson'),
+        'kml': (KmlWriter, 'detections.kml'),
+        'csv': (CsvWriter, 'labels.csv'),
+        'parquet': (ParquetWriter, 'labels.parquet'),
+    }
+
+    stopwatch = utils.Stopwatch()
+    counts: Dict[str, int] = {'images': 0, 'labels': 0, 'crops': 0, 'failed': 0}
+
+    with ExitStack() as stack:
+        writers = []
+        for export_format in options.formats:
+            if export_format in writer_types:
+                writer_type, filename = writer_types[export_format]
+                LOGGER.info(f'Write {export_format} to "{filename}"...')
+                writer = writer_type(options.output_dir / filename)
+                stack.callback(writer.close)
+                writers.append(writer)
+
+        def crop_tasks() -> Iterable[CropTask]:
+            for _, group in itertools.groupby(query_rows(options), key=lambda row: row.image_id):
+                rows = list(group)
+                for row in rows:
+                    for writer in writers:
+                        writer.write(row)
+
+                counts['images'] += 1
+                counts['labels'] += len(rows)
+                yield CropTask(storage.IMAGES_DIR / rows[0].image_path, rows[0].original_width, rows,
+                               options.crop_size)
+
+        if 'crops' not in options.formats:
+            for _ in crop_tasks():
+                pass
+        else:
+            LOGGER.info(f'Write crops to "crops.zip" using {options.workers} workers...')
+            archive = stack.enter_context(zipfile.ZipFile(options.output_dir / 'crops.zip', 'w'))
+            executor = stack.enter_context(ProcessPoolExecutor(options.workers))
+            for result in utils.bounded_map(executor, crop_image, crop_tasks(), options.workers * 2):
+                if result.error is not None:
+                    LOGGER.warning(f'Skip crops of "{result.image_path}": {result.error}')
+                    counts['failed'] += 1
+                for name, data in result.crops:
+                    archive.writestr(name, data)
+                counts['crops'] += len(result.crops)
+
+    LOGGER.info(f'Exported {counts["labels"]} labels from {counts["images"]} images, {counts["crops"]} crops '
+                f'({counts["failed"]} images failed) in {stopwatch.elapsed(seconds_rounding=int)}')
+
+
+def configure_logging(logger: logging.Logger, output_path: Path):
+    formatter = logging.Formatter('%(asctime)s [%(levelname)5s] %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.DEBUG)
+    logger.addHandler(stream_handler)
+
+    file_handler = logging.FileHandler(output_path, 'wt', encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+
+    logger.setLevel(1) # min level
+
+
+def parse_command_line_options() -> ProgramOptions:
+    parser = argparse.ArgumentParser(
+        description='Export detections of uploads or a rescue operation.',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--upload', dest='upload_ids', type=int, action='append',
+                        help='id of the upload to export (can be repeated)')
+
+    parser.add_argument('--rescue-operation', dest='rescue_operation', type=str,
+                        help='name of the rescue operation to export')
+
+    parser.add_argument('--formats', dest='formats', nargs='+', choices=EXPORT_FORMATS,
+                        help='output formats (default: %(default)s)')
+
+    parser.add_argument('--min-confidence', dest='min_confidence', type=float,
+                        help='export only labels with at least this confidence (default: %(default)s)')
+
+    parser.add_argument('--crop-size', dest='crop_size', type=int,
+                        help='size of the crops around detections (default: %(default)s)')
+
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='number of processes generating crops (default: %(default)s)')
+
+    parser.add_argument('output_dir', type=Path,
+                        help='path to the output directory')
+
+    parser.set_defaults(formats=EXPORT_FORMATS, min_confidence=0.0, crop_size=200, workers=os.cpu_count() or 1)
+
+    args = parser.parse_args()
+
+    if not args.upload_ids and args.rescue_operation is None:
+        parser.error('one of the arguments --upload --rescue-operation is required')
+
+    if args.workers < 1:
+        parser.error('argument --workers: must be positive')
+
+    return ProgramOptions(**vars(args))
+
+
+def main():
+    options = parse_command_line_options()
+
+    options.output_dir.mkdir(exist_ok=True, parents=True)
+
+    configure_logging(LOGGER, options.output_dir / 'export.log')
+
+    LOGGER.info('Program options:\n' + textwrap.indent(
+        '\n'.join(f'{name} = {options[i]}' for i, name in enumerate(options._fields)), '  '))
+
+    export(options)
+
+
+if __name__ == '__main__':
+    main()
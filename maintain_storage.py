@@ -0,0 +1,308 @@
+﻿import argparse
+import datetime as dt
+import logging
+import os
+import textwrap
+import zipfile
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from PIL import Image
+from peewee import JOIN, fn
+
+import settings
+import storage
+import utils
+
+
+LOGGER = logging.getLogger('maintain_storage')
+
+# deflating already compressed images saves about 2% at a high CPU cost
+COMPRESSED_SUFFIXES = ['.jpg', '.jpeg', '.png']
+
+
+class ProgramOptions(NamedTuple):
+    older_than: int
+    rescue_operations: Optional[List[str]]
+    mode: str
+    archive_dir: Path
+    max_size: int
+    quality: int
+    dry_run: bool
+
+
+class StorageSize(NamedTuple):
+    images: int
+    thumbnails: int
+    database: int
+
+    @property
+    def total(self) -> int:
+        return self.images + self.thumbnails + self.database
+
+
+def directory_size(path: Path) -> int:
+    if not path.exists():
+        return 0
+    return sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+
+
+def measure_storage_size() -> StorageSize:
+    return StorageSize(
+        images=directory_size(storage.IMAGES_DIR),
+        thumbnails=directory_size(storage.THUMBNAILS_DIR),
+        database=storage.DATABASE_PATH.stat().st_size)
+
+
+def measure_query_latency(repeat: int = 5) -> float:
+    # queries used by the Journal, Detect and Map pages
+    queries = [
+        lambda: storage.Image.select(storage.Image, storage.Upload).join(storage.Upload).tuples(),
+        lambda: (storage.Label
+                 .select(storage.Label.image, fn.COUNT(storage.Label.id))
+                 .group_by(storage.Label.image)
+                 .tuples()),
+        lambda: storage.Sighting.select().order_by(storage.Sighting.last_seen).tuples(),
+    ]
+
+    stopwatch = utils.Stopwatch()
+    for _ in range(repeat):
+        for query in queries:
+            list(query())
+
+    return stopwatch.elapsed_seconds() / repeat
+
+
+def format_size(size: int) -> str:
+    return f'{size / 1024 / 1024:.1f} MB'
+
+
+def save_thumbnails(image_info: storage.Image, image: Image.Image):
+    patch_size = 200
+    for label in image_info.labels:
+        path = storage.thumbnail_path(image_info, label)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        patch = utils.crop_patch(image, label.xc, label.yc, patch_size)
+        patch.convert('RGB').save(path, quality=90)
+
+
+def archive_originals(images: List[storage.Image], archive_path: Path) -> bool:
+    # originals are written, flushed to disk and verified before any of them is replaced
+    with zipfile.ZipFile(archive_path, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        archived_names = set(archive.namelist())
+        for image_info in images:
+            if image_info.path not in archived_names:
+                LOGGER.debug(f'Archive image: {image_info.path}')
+                path = storage.IMAGES_DIR / image_info.path
+                compress_type = (zipfile.ZIP_STORED if path.suffix.lower() in COMPRESSED_SUFFIXES
+                                 else zipfile.ZIP_DEFLATED)
+                archive.write(path, arcname=image_info.path, compress_type=compress_type)
+
+    with archive_path.open('r+b') as file:
+        os.fsync(file.fileno())
+
+    with zipfile.ZipFile(archive_path) as archive:
+        corrupted = archive.testzip()
+        archived_names = set(archive.namelist())
+
+    if corrupted is not None:
+        LOGGER.error(f'Archive {archive_path} is corrupted ({corrupted}), originals are kept')
+        return False
+
+    missing = [image_info.path for image_info in images if image_info.path not in archived_names]
+    if missing:
+        LOGGER.error(f'Archive {archive_path} misses {len(missing)} images, originals are kept')
+        return False
+
+    return True
+
+
+def reduce_image(image_info: storage.Image, archive_name: Optional[str], options: ProgramOptions):
+    path = storage.IMAGES_DIR / image_info.path
+    temp_path = path.with_name(path.stem + '.tmp' + path.suffix)
+
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            save_thumbnails(image_info, image)
+
+            image.thumbnail((options.max_size, options.max_size))
+            if path.suffix.lower() in ('.jpg', '.jpeg'):
+                image.convert('RGB').save(temp_path, quality=options.quality, optimize=True)
+            else:
+                image.save(temp_path, optimize=True)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    # the row is committed first: if the process stops before the replace, the original stays
+    # with its own size recorded, while a reduced file without a row would be taken as the original
+    with storage.atomic():
+        storage.ArchivedImage.create(
+            image=image_info,
+            timestamp=dt.datetime.now(),
+            width=width,
+            height=height,
+            archive=archive_name)
+    os.replace(temp_path, path)
+
+
+def recorded_archive_path(archive_path: Path) -> str:
+    # archives in the storage are recorded relative to it, archives on another volume by full path
+    if archive_path.resolve().is_relative_to(storage.ARCHIVES_DIR.resolve()):
+        return archive_path.resolve().relative_to(storage.ARCHIVES_DIR.resolve()).as_posix()
+    return archive_path.resolve().as_posix()
+
+
+def select_uploads(options: ProgramOptions) -> List[storage.Upload]:
+    query = storage.Upload.select().where(
+        storage.Upload.timestamp < dt.datetime.now() - dt.timedelta(days=options.older_than))
+    if options.rescue_operations:
+        query = query.where(storage.Upload.rescue_operation.in_(options.rescue_operations))
+    return list(query.order_by(storage.Upload.id))
+
+
+def apply_retention(options: ProgramOptions):
+    uploads = select_uploads(options)
+    LOGGER.info(f'Upload count: {len(uploads)}')
+
+    options.archive_dir.mkdir(parents=True, exist_ok=True)
+
+    for upload in uploads:
+        images = list(storage.Image
+                      .select()
+                      .join(storage.ArchivedImage, JOIN.LEFT_OUTER)
+                      .where((storage.Image.upload == upload) & storage.ArchivedImage.id.is_null())
+                      .order_by(storage.Image.id))
+
+        LOGGER.info(f'Upload {upload.id} ({upload.rescue_operation}, {upload.timestamp:%Y-%m-%d}): '
+                    f'{len(images)} images to reduce')
+        if not images or options.dry_run:
+            continue
+
+        present = []
+        for image_info in images:
+            if (storage.IMAGES_DIR / image_info.path).exists():
+                present.append(image_info)
+            else:
+                LOGGER.warning(f'Image not found: {storage.IMAGES_DIR / image_info.path}')
+
+        archive_name = None
+        if options.mode == 'archive' and present:
+            archive_path = options.archive_dir / f'upload-{upload.id}.zip'
+            try:
+                if not archive_originals(present, archive_path):
+                    continue
+            except (OSError, zipfile.BadZipFile) as e:
+                LOGGER.error(f'Failed to archive upload {upload.id}, originals are kept: {e}')
+                continue
+            archive_name = recorded_archive_path(archive_path)
+
+        for image_info in present:
+            LOGGER.debug(f'Reduce image: {image_info.path}')
+            try:
+                reduce_image(image_info, archive_name, options)
+            except OSError as e:
+                # a broken original must not stop the run before the database is optimized
+                LOGGER.warning(f'Skip image {image_info.path}: {e}')
+
+
+def maintain(options: ProgramOptions):
+    if options.mode == 'archive' and options.archive_dir.resolve().is_relative_to(settings.STORAGE_DIR.resolve()):
+        LOGGER.warning('Archives are kept in the storage, reduced copies take space in addition to the originals, '
+                       'use --archive-dir to move them to another volume')
+
+    LOGGER.info('Measure storage...')
+    size_before = measure_storage_size()
+    archives_before = directory_size(options.archive_dir)
+    latency_before = measure_query_latency()
+
+    apply_retention(options)
+
+    if not options.dry_run:
+        LOGGER.info('Optimize database (VACUUM, ANALYZE, REINDEX)...')
+        storage.optimize_database()
+
+    size_after = measure_storage_size()
+    archives_after = directory_size(options.archive_dir)
+    latency_after = measure_query_latency()
+
+    LOGGER.info('Report:\n' + textwrap.indent('\n'.join([
+        f'{name:10} {format_size(before):>12} -> {format_size(after):>12}'
+        for name, before, after in zip(StorageSize._fields + ('total',),
+                                       size_before + (size_before.total,),
+                                       size_after + (size_after.total,))] + [
+        f'reclaimed  {format_size(size_before.total - size_after.total):>12}',
+        f'archives   {format_size(archives_before):>12} -> {format_size(archives_after):>12} '
+        f'in {options.archive_dir}',
+        f'queries    {latency_before * 1000:>9.1f} ms -> {latency_after * 1000:>9.1f} ms',
+    ]), '  '))
+
+
+def configure_logging(logger: logging.Logger, output_path: Path):
+    formatter = logging.Formatter('%(asctime)s [%(levelname)5s] %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.INFO)
+    logger.addHandler(stream_handler)
+
+    file_handler = logging.FileHandler(output_path, 'at', encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+
+    logger.setLevel(1) # min level
+
+
+def parse_command_line_options() -> ProgramOptions:
+    parser = argparse.ArgumentParser(
+        description='Apply retention policies to the image store and optimize the database.',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--older-than', dest='older_than', type=int,
+                        help='reduce images of uploads older than this number of days (default: %(default)s)')
+
+    parser.add_argument('--rescue-operation', dest='rescue_operations', action='append',
+                        help='reduce only uploads of this rescue operation (can be repeated)')
+
+    parser.add_argument('--mode', dest='mode', choices=['archive', 'downscale'],
+                        help='"archive" keeps originals in zip archives, '
+                             '"downscale" keeps only reduced copies (default: %(default)s)')
+
+    parser.add_argument('--archive-dir', dest='archive_dir', type=Path,
+                        help='directory for zip archives of originals, '
+                             'can be on another volume (default: %(default)s)')
+
+    parser.add_argument('--max-size', dest='max_size', type=int,
+                        help='max side of reduced images (default: %(default)s)')
+
+    parser.add_argument('--quality', dest='quality', type=int,
+                        help='JPEG quality of reduced images (default: %(default)s)')
+
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='only report what would be reduced')
+
+    parser.set_defaults(older_than=30, mode='archive', archive_dir=storage.ARCHIVES_DIR, max_size=2048, quality=85)
+
+    args = parser.parse_args()
+
+    if args.older_than < 0:
+        parser.error('argument --older-than: must be non-negative')
+
+    return ProgramOptions(**vars(args))
+
+
+def main():
+    options = parse_command_line_options()
+
+    configure_logging(LOGGER, settings.STORAGE_DIR / 'maintenance.log')
+
+    LOGGER.info('Program options:\n' + textwrap.indent(
+        '\n'.join(f'{name} = {options[i]}' for i, name in enumerate(options._fields)), '  '))
+
+    maintain(options)
+
+
+if __name__ == '__main__':
+    main()
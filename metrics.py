@@ -0,0 +1,92 @@
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+class MatchedPredictions(NamedTuple):
+    scores: np.ndarray  # (N,)
+    true_positives: np.ndarray  # (len(match_ious), N)
+    ground_truth_count: int
+
+
+def xywhn_to_xyxy(boxes: np.ndarray, width: Union[float, np.ndarray], height: Union[float, np.ndarray]) -> np.ndarray:
+    xc, yc, w, h = boxes[:, 0] * width, boxes[:, 1] * height, boxes[:, 2] * width, boxes[:, 3] * height
+    return np.column_stack([xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2])
+
+
+def box_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+    return intersection / (area1[:, None] + area2[None, :] - intersection)
+
+
+def match_predictions(predictions: pd.DataFrame, ground_truth: Dict[str, np.ndarray],
+                      match_ious: List[float]) -> MatchedPredictions:
+    thresholds = np.array(match_ious)
+    scores = []
+    true_positives = []
+
+    for image, group in predictions.groupby('image', sort=False):
+        group = group.sort_values('score', ascending=False)
+        gt_boxes = ground_truth[image]
+        image_tp = np.zeros((len(thresholds), len(group)), dtype=bool)
+
+        if len(gt_boxes) > 0:
+            ious = box_iou(group[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(), gt_boxes)
+            matched = np.zeros((len(thresholds), len(gt_boxes)), dtype=bool)
+            rows = np.arange(len(thresholds))
+
+            # greedy matching in score order, vectorized over IoU thresholds
+            for i in range(len(group)):
+                candidates = np.where((ious[i][None, :] >= thresholds[:, None]) & ~matched, ious[i][None, :], -1.0)
+                best = candidates.argmax(axis=1)
+                hit = candidates[rows, best] >= 0
+                matched[rows[hit], best[hit]] = True
+                image_tp[:, i] = hit
+
+        scores.append(group['score'].to_numpy())
+        true_positives.append(image_tp)
+
+    ground_truth_count = sum(len(boxes) for boxes in ground_truth.values())
+    if not scores:
+        return MatchedPredictions(np.zeros(0), np.zeros((len(thresholds), 0), dtype=bool), ground_truth_count)
+
+    return MatchedPredictions(np.concatenate(scores), np.concatenate(true_positives, axis=1), ground_truth_count)
+
+
+def compute_metrics(matched: MatchedPredictions, confidence: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # greedy matching depends only on higher scored boxes, so a confidence threshold just truncates the list
+    mask = matched.scores >= confidence
+    order = np.argsort(-matched.scores[mask], kind='stable')
+    true_positives = matched.true_positives[:, mask][:, order]
+
+    threshold_count = true_positives.shape[0]
+    if true_positives.shape[1] == 0:
+        zeros = np.zeros(threshold_count)
+        return zeros, zeros, zeros
+
+    tp_cumsum = np.cumsum(true_positives, axis=1)
+    fp_cumsum = np.cumsum(~true_positives, axis=1)
+    recall_curve = tp_cumsum / max(matched.ground_truth_count, 1)
+    precision_curve = tp_cumsum / (tp_cumsum + fp_cumsum)
+
+    # COCO-style 101 point interpolated average precision
+    envelope = np.flip(np.maximum.accumulate(np.flip(precision_curve, axis=1), axis=1), axis=1)
+    recall_points = np.linspace(0, 1, 101)
+    average_precision = np.zeros(threshold_count)
+    for k in range(threshold_count):
+        indices = np.searchsorted(recall_curve[k], recall_points, side='left')
+        indices = indices[indices < len(recall_curve[k])]
+        average_precision[k] = envelope[k, indices].sum() / len(recall_points)
+
+    return precision_curve[:, -1], recall_curve[:, -1], average_precision
+
+
+def pareto_optimal(recall: np.ndarray, speed: np.ndarray) -> np.ndarray:
+    dominated = ((recall[None, :] >= recall[:, None]) & (speed[None, :] >= speed[:, None])
+                 & ((recall[None, :] > recall[:, None]) | (speed[None, :] > speed[:, None])))
+    return ~dominated.any(axis=1)
@@ -1,17 +1,53 @@
 ﻿import datetime as dt
-import io
+import math
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
 
+import numpy as np
+import psutil
 import streamlit as st
+from peewee import DatabaseError
 from PIL import Image
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
+import resolution
+import runtime
 import settings
+import sightings
 import storage
 import ui
 import utils
 
 
-@st.cache_resource(show_spinner='Загрузка модели YOLO8...')
-def get_model():
+class StoredImage(NamedTuple):
+    name: str
+    path: Path
+    timestamp: Optional[dt.datetime]
+    latitude: Optional[float]
+    longitude: Optional[float]
+    width: int
+    height: int
+    image_size: int
+    image: np.ndarray
+
+
+RUNTIME_CONFIG = runtime.RuntimeConfig(
+    intra_op_threads=settings.RUNTIME_INTRA_OP_THREADS,
+    inter_op_threads=settings.RUNTIME_INTER_OP_THREADS,
+    replicas=settings.RUNTIME_REPLICAS,
+    decode_workers=settings.RUNTIME_DECODE_WORKERS,
+    pin_cores=settings.RUNTIME_PIN_CORES)
+
+ADAPTIVE_SIZE_CONFIG = resolution.AdaptiveSizeConfig(
+    sizes=settings.YOLO8_ADAPTIVE_SIZES,
+    person_size_m=settings.YOLO8_ADAPTIVE_PERSON_SIZE_M,
+    person_pixels=settings.YOLO8_ADAPTIVE_PERSON_PIXELS,
+    focal_length_35mm=settings.YOLO8_ADAPTIVE_FOCAL_LENGTH_35MM,
+    ground_altitude_m=settings.YOLO8_ADAPTIVE_GROUND_ALTITUDE_M)
+
+
+def load_model():
     print('Load YOLO model...')
 
     import ultralytics
@@ -22,21 +58,93 @@ def get_model():
     return model
 
 
+@st.cache_resource(show_spinner='Загрузка модели YOLO8...')
+def get_model_pool():
+    return runtime.ModelPool(load_model, RUNTIME_CONFIG)
+
+
+@st.cache_resource
+def get_preview_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='preview')
+
+
+def get_prefetcher():
+    if 'review_prefetcher' not in st.session_state:
+        st.session_state['review_prefetcher'] = ui.PreviewPrefetcher(
+            get_preview_executor(),
+            max_size=settings.REVIEW_PREVIEW_SIZE,
+            max_entries=settings.REVIEW_PAGE_SIZE + settings.REVIEW_PREFETCH)
+    return st.session_state['review_prefetcher']
+
+
+def store_image(uploaded_file: UploadedFile) -> StoredImage:
+    print('Store file:', uploaded_file.name)
+    uploaded_file.seek(0)
+    image_path = storage.upload_image_file(uploaded_file, uploaded_file.name)
+    uploaded_file.close()
+
+    with Image.open(storage.IMAGES_DIR / image_path) as image:
+        latitude, longitude = utils.get_gps_coordinates(image)
+
+        image_size = settings.YOLO8_IMAGE_SIZE
+        if settings.YOLO8_ADAPTIVE_SIZE:
+            image_size = resolution.select_image_size(image, ADAPTIVE_SIZE_CONFIG, settings.YOLO8_IMAGE_SIZE)
+
+        return StoredImage(
+            name=uploaded_file.name,
+            path=image_path,
+            timestamp=utils.get_datetime_original(image),
+            latitude=latitude,
+            longitude=longitude,
+            width=image.size[0],
+            height=image.size[1],
+            image_size=image_size,
+            image=utils.read_image(storage.IMAGES_DIR / image_path))
+
+
 def show_results():
     if 'upload_id' not in st.session_state:
         return
 
     upload_id = st.session_state['upload_id']
-    upload_info = storage.Upload.get(storage.Upload.id == upload_id)
 
-    human_count = sum(len(image_info.labels) for image_info in upload_info.images)
+    human_count = (storage.Label
+                   .select()
+                   .join(storage.Image)
+                   .where(storage.Image.upload == upload_id)
+                   .count())
     if human_count > 0:
         st.success('Обнаружены люди!')
     else:
         st.info('Люди не обнаружены')
 
-    for image_info in upload_info.images:
-        ui.show_detection_results(image_info)
+    review_modes = {
+        'Сначала наиболее вероятные': settings.REVIEW_SCORE,
+        'В порядке загрузки': 'upload',
+    }
+    review_mode = st.radio('Порядок просмотра:', list(review_modes), horizontal=True, key='review_mode')
+    ranked_images = storage.rank_images(upload_id, review_modes[review_mode])
+    if not ranked_images:
+        return
+
+    page_size = settings.REVIEW_PAGE_SIZE
+    page_count = math.ceil(len(ranked_images) / page_size)
+    if st.session_state.get('review_page', 1) > page_count:
+        st.session_state['review_page'] = page_count
+    page = st.number_input('Страница:', min_value=1, max_value=page_count, key='review_page') - 1
+    st.caption(f'Изображений: {len(ranked_images)}, страниц: {page_count}')
+
+    page_images = ranked_images[page * page_size:(page + 1) * page_size]
+    next_images = ranked_images[(page + 1) * page_size:(page + 1) * page_size + settings.REVIEW_PREFETCH]
+
+    prefetcher = get_prefetcher()
+    prefetcher.prefetch(image_id for image_id, _ in page_images + next_images)
+
+    for image_id, score in page_images:
+        results = prefetcher.get(image_id)
+        ui.show_rendered_results(results)
+        if score is not None:
+            st.caption(f'Оценка изображения: {score:.2f}')
 
 
 def main():
@@ -59,16 +167,17 @@ def main():
         submitted = st.form_submit_button('Обработать изображения')
 
     if not submitted:
-        #show_results()
+        show_results()
         return
 
     if not uploaded_files:
         return
 
-    if 'upload_id' in st.session_state:
-        del st.session_state['upload_id']
+    for key in ['upload_id', 'review_page', 'review_prefetcher']:
+        if key in st.session_state:
+            del st.session_state[key]
 
-    model = get_model()
+    model_pool = get_model_pool()
 
     upload_info = storage.Upload.create(
         timestamp=dt.datetime.now(),
@@ -76,28 +185,32 @@ def main():
 
     progress_bar = st.progress(0)
 
-    with st.spinner('Обработка изображений...'):
-        for i, uploaded_file in enumerate(uploaded_files):
-            print('Process file:', uploaded_file.name)
-            bytes_data = uploaded_file.getvalue()
+    start_rss = psutil.Process().memory_info().rss
+    start_peak_rss = runtime.peak_rss()
 
-            image = Image.open(io.BytesIO(bytes_data))
-            latitude, longitude = utils.get_gps_coordinates(image)
+    monitor = runtime.UtilizationMonitor()
+    image_sizes = []
 
-            image_path = storage.upload_image(bytes_data, uploaded_file.name)
+    with st.spinner('Обработка изображений...'), \
+            model_pool.acquire() as model, \
+            ThreadPoolExecutor(settings.RUNTIME_DECODE_WORKERS) as executor:
+        stored_images = utils.bounded_map(executor, store_image, uploaded_files, settings.UPLOAD_MAX_IN_FLIGHT)
+        for i, stored_image in enumerate(stored_images):
+            print('Process file:', stored_image.name)
             image_info = storage.Image.create(
                 upload=upload_info,
-                timestamp=utils.get_datetime_original(image),
-                path=image_path.as_posix(),
-                original_name=uploaded_file.name,
-                longitude=longitude,
-                latitude=latitude)
-
-            image_width = image.size[0]
-            image_height = image.size[1]
-
-            results = model.predict(source=image, conf=settings.YOLO8_CONF_THRESHOLD,
-                                    iou=settings.YOLO8_IOU_THRESHOLD, imgsz=settings.YOLO8_IMAGE_SIZE,
+                timestamp=stored_image.timestamp,
+                path=stored_image.path.as_posix(),
+                original_name=stored_image.name,
+                longitude=stored_image.longitude,
+                latitude=stored_image.latitude)
+
+            image_width = stored_image.width
+            image_height = stored_image.height
+            image_sizes.append(stored_image.image_size)
+
+            results = model.predict(source=stored_image.image, conf=settings.YOLO8_CONF_THRESHOLD,
+                                    iou=settings.YOLO8_IOU_THRESHOLD, imgsz=stored_image.image_size,
                                     device=settings.YOLO8_DEVICE, classes=0, verbose=False)
             for result in results:
                 for ((xc, yc, w, h), conf) in zip(result.boxes.xywhn.tolist(), result.boxes.conf.tolist()):
@@ -107,9 +220,35 @@ def main():
                     ymin = (yc - h/2) * image_height
                     ymax = (yc + h/2) * image_height
                     storage.Label.create(image=image_info, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, confidence=conf)
+            del results, stored_image
 
             progress_bar.progress((i + 1) / len(uploaded_files))
 
+        try:
+            sightings.update_sightings(settings.SIGHTINGS_DISTANCE_M, settings.SIGHTINGS_TIME_WINDOW_S)
+        except DatabaseError as e:
+            # the upload is already saved, sightings are updated again by the next upload or the map page
+            print('Failed to update sightings:', e)
+            st.warning('Не удалось обновить наблюдения на карте, они будут обновлены позже')
+
+    with st.expander('Конфигурация выполнения'):
+        st.text(runtime.format_report(RUNTIME_CONFIG, model_pool.core_sets, monitor.stop(),
+                                     shared_thread_pool=True))
+
+    if settings.YOLO8_ADAPTIVE_SIZE:
+        compute = resolution.relative_compute(image_sizes, settings.YOLO8_IMAGE_SIZE)
+        st.caption(f'Адаптивный размер изображений: вычисления составили {compute * 100:.0f}% '
+                   f'от обработки с фиксированным размером {settings.YOLO8_IMAGE_SIZE}')
+
+    end_peak_rss = runtime.peak_rss()
+    if start_peak_rss is not None and end_peak_rss is not None:
+        mb = 1024 * 1024
+        if end_peak_rss > start_peak_rss:
+            peak = f'пиковая {end_peak_rss / mb:.0f} МБ (+{(end_peak_rss - start_rss) / mb:.0f} МБ)'
+        else:
+            peak = f'пиковая не превысила предыдущий пик процесса {start_peak_rss / mb:.0f} МБ'
+        st.caption(f'Память: в начале обработки {start_rss / mb:.0f} МБ, {peak}')
+
     st.session_state['upload_id'] = upload_info.id
     show_results()
 
@@ -4,8 +4,11 @@ import numpy as np
 import streamlit as st
 
 import folium
+from peewee import DatabaseError
 from streamlit_folium import st_folium
 
+import settings
+import sightings
 import storage
 import ui
 
@@ -26,16 +29,38 @@ def main():
     st.markdown("""
     На карте отмечена привязка загруженных изображений к местности.
     
-    Зеленые маркеры используются для изображений, на которых были обнаружены люди.
+    Зеленые маркеры используются для мест, в которых были обнаружены люди. Обнаружения на соседних
+    по времени и месту снимках объединяются в одну встречу.
     Синие маркеры используются для изображений без людей.
     """)
 
+    try:
+        sightings.update_sightings(settings.SIGHTINGS_DISTANCE_M, settings.SIGHTINGS_TIME_WINDOW_S)
+    except DatabaseError as e:
+        # the map shows the sightings stored so far
+        print('Failed to update sightings:', e)
+
     lat_list = []
     lon_list = []
     markers_with_humans = []
     markers_without_humans = []
+    for sighting in storage.Sighting.select():
+        tooltip = '<b>' + sighting.first_seen.strftime('%Y-%m-%d %H:%M') + '</b>'
+        if sighting.image.upload.rescue_operation:
+            tooltip += f' | <b>{sighting.image.upload.rescue_operation}</b>'
+        tooltip += f'<br>Обнаружений: {sighting.label_count}, уверенность: {sighting.confidence:.2f}'
+        tooltip += f'<br>{sighting.image.original_name}'
+
+        marker = folium.Marker(
+            location=[sighting.latitude, sighting.longitude],
+            tooltip=tooltip, icon=folium.Icon(color='green', icon='user', prefix='fa'))
+
+        lat_list.append(sighting.latitude)
+        lon_list.append(sighting.longitude)
+        markers_with_humans.append(marker)
+
     for image in storage.Image.select():
-        if image.latitude is None:
+        if image.latitude is None or len(image.labels) > 0:
             continue
 
         tooltip = ''
@@ -47,22 +72,13 @@ def main():
             tooltip += f'<b>{image.upload.rescue_operation}</b>'
         tooltip += f'<br>{image.original_name}'
 
-        if len(image.labels) > 0:
-            icon = folium.Icon(color='green', icon='user', prefix='fa')
-        else:
-            icon = None
-
         marker = folium.Marker(
             location=[image.latitude, image.longitude],
-            tooltip=tooltip, icon=icon)
+            tooltip=tooltip)
 
         lat_list.append(image.latitude)
         lon_list.append(image.longitude)
-
-        if len(image.labels) > 0:
-            markers_with_humans.append(marker)
-        else:
-            markers_without_humans.append(marker)
+        markers_without_humans.append(marker)
 
     if not markers_with_humans and not markers_without_humans:
         st.write('Нет обработанных изображений с GPS-координатами.')
@@ -89,7 +105,21 @@ def main():
     latitude = last_object_clicked['lat']
     longitude = last_object_clicked['lng']
 
-    image_info = storage.Image.get(storage.Image.longitude == longitude and storage.Image.latitude == latitude)
+    sighting = storage.Sighting.get_or_none(
+        (storage.Sighting.longitude == longitude) & (storage.Sighting.latitude == latitude))
+    if sighting is not None:
+        image_count = (storage.SightingLabel
+                       .select(storage.Label.image)
+                       .join(storage.Label)
+                       .where(storage.SightingLabel.sighting == sighting)
+                       .distinct()
+                       .count())
+        st.write(f'Снимков с этой встречей: {image_count}')
+        ui.show_detection_results(sighting.image)
+        return
+
+    image_info = storage.Image.get(
+        (storage.Image.longitude == longitude) & (storage.Image.latitude == latitude))
     ui.show_detection_results(image_info)
 
 
@@ -0,0 +1,58 @@
+﻿import math
+from typing import Iterable, List, NamedTuple, Optional
+
+import utils
+
+
+# width of a full frame sensor, focal lengths are given for it
+FULL_FRAME_WIDTH_MM = 36.0
+
+
+class AdaptiveSizeConfig(NamedTuple):
+    sizes: List[int]
+    person_size_m: float
+    person_pixels: int
+    focal_length_35mm: float
+    ground_altitude_m: float
+
+
+def get_height_above_ground(image, config: AdaptiveSizeConfig) -> Optional[float]:
+    relative_altitude = utils.get_relative_altitude(image)
+    if relative_altitude is not None:
+        return relative_altitude
+
+    altitude = utils.get_altitude(image)
+    if altitude is None:
+        return None
+    return altitude - config.ground_altitude_m
+
+
+def select_image_size(image, config: AdaptiveSizeConfig, default_size: int) -> int:
+    height = get_height_above_ground(image, config)
+    if height is None or height <= 0:
+        return default_size
+
+    focal_length = utils.get_focal_length_35mm(image) or config.focal_length_35mm
+    width, image_height = image.size
+
+    # the 36 mm of the full frame correspond to the long side of the image
+    long_side = max(width, image_height)
+    ground_width_m = height * FULL_FRAME_WIDTH_MM / focal_length
+    person_pixels = config.person_size_m / ground_width_m * long_side
+
+    # the model input is the long side scaled to the image size, upscaling adds no detail
+    required_size = min(long_side, math.ceil(config.person_pixels * long_side / person_pixels))
+
+    sizes = sorted(config.sizes)
+    for size in sizes:
+        if size >= required_size:
+            return size
+    return sizes[-1]
+
+
+def relative_compute(image_sizes: Iterable[int], fixed_size: int) -> float:
+    # the cost of a convolutional detector grows with the input area
+    image_sizes = list(image_sizes)
+    if not image_sizes:
+        return 1.0
+    return sum(size * size for size in image_sizes) / (len(image_sizes) * fixed_size * fixed_size)
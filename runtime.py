@@ -0,0 +1,190 @@
+﻿import contextlib
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Sequence
+
+import psutil
+
+
+LOGGER = logging.getLogger('runtime')
+
+
+class RuntimeConfig(NamedTuple):
+    intra_op_threads: int  # 0 - one thread per core of the replica
+    inter_op_threads: int  # 0 - torch default
+    replicas: int
+    decode_workers: int
+    pin_cores: bool
+
+
+class Utilization(NamedTuple):
+    wall_seconds: float
+    process_seconds: float
+    per_core: List[float]
+
+
+def available_cores() -> List[int]:
+    process = psutil.Process()
+    if hasattr(process, 'cpu_affinity'):
+        return sorted(process.cpu_affinity())
+    return list(range(psutil.cpu_count()))
+
+
+def partition_cores(cores: Sequence[int], parts: int) -> List[List[int]]:
+    size, remainder = divmod(len(cores), parts)
+    partitions = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < remainder else 0)
+        # with more replicas than cores some replicas have to share a core
+        partitions.append(list(cores[start:end]) or [cores[i % len(cores)]])
+        start = end
+    return partitions
+
+
+def effective_intra_op_threads(config: RuntimeConfig, cores: Sequence[int]) -> int:
+    return config.intra_op_threads or len(cores)
+
+
+def configure_torch(config: RuntimeConfig, cores: Sequence[int]):
+    import torch
+
+    torch.set_num_threads(effective_intra_op_threads(config, cores))
+    if config.inter_op_threads:
+        try:
+            torch.set_num_interop_threads(config.inter_op_threads)
+        except RuntimeError:
+            LOGGER.warning('Inter-op threads can only be set before the first parallel work, ignored')
+
+
+def pin_process(cores: Sequence[int]) -> bool:
+    # threads created afterwards (torch, decode workers) inherit the affinity
+    process = psutil.Process()
+    if not hasattr(process, 'cpu_affinity'):
+        return False
+    process.cpu_affinity(list(cores))
+    return True
+
+
+def get_thread_affinity() -> Optional[List[int]]:
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    return sorted(os.sched_getaffinity(threading.get_native_id()))
+
+
+def pin_thread(cores: Sequence[int]) -> bool:
+    # Linux only: affinity of the calling thread, inherited by the threads it starts
+    if not hasattr(os, 'sched_setaffinity'):
+        return False
+    os.sched_setaffinity(threading.get_native_id(), cores)
+    return True
+
+
+class ModelPool:
+
+    def __init__(self, load_model: Callable[[], Any], config: RuntimeConfig):
+        self.config = config
+        self.core_sets = partition_cores(available_cores(), config.replicas)
+        # torch threads are process-global: replicas in one process share a pool sized for one replica
+        configure_torch(config, self.core_sets[0])
+
+        self._free: queue.Queue = queue.Queue()
+        for cores in self.core_sets:
+            self._free.put((load_model(), cores))
+
+    @contextlib.contextmanager
+    def acquire(self) -> Iterator[Any]:
+        model, cores = self._free.get()
+        previous_affinity = get_thread_affinity()
+        pinned = self.config.pin_cores and pin_thread(cores)
+        try:
+            yield model
+        finally:
+            if pinned and previous_affinity is not None:
+                pin_thread(previous_affinity)
+            self._free.put((model, cores))
+
+
+class UtilizationMonitor:
+
+    def __init__(self):
+        self._process = psutil.Process()
+        self._start_time = time.perf_counter()
+        self._start_process_seconds = self._process_seconds()
+        self._start_cores = psutil.cpu_times(percpu=True)
+
+    def _process_seconds(self) -> float:
+        times = self._process.cpu_times()
+        # children times are available after the worker processes have been joined
+        return (times.user + times.system
+                + getattr(times, 'children_user', 0.0) + getattr(times, 'children_system', 0.0))
+
+    def stop(self) -> Utilization:
+        per_core = []
+        for before, after in zip(self._start_cores, psutil.cpu_times(percpu=True)):
+            total = sum(after) - sum(before)
+            idle = after.idle - before.idle + getattr(after, 'iowait', 0.0) - getattr(before, 'iowait', 0.0)
+            per_core.append(100 * (1 - idle / total) if total > 0 else 0.0)
+
+        return Utilization(
+            wall_seconds=time.perf_counter() - self._start_time,
+            process_seconds=self._process_seconds() - self._start_process_seconds,
+            per_core=per_core)
+
+
+def peak_rss() -> Optional[int]:
+    # high-water mark of the process over its lifetime, catches peaks between samples
+    try:
+        import resource
+    except ImportError:  # Windows
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+
+
+def format_cores(cores: Sequence[int]) -> str:
+    ranges = []
+    for core in cores:
+        if ranges and ranges[-1][1] == core - 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(f'{first}-{last}' if first != last else f'{first}' for first, last in ranges)
+
+
+def format_report(config: RuntimeConfig, core_sets: List[List[int]], utilization: Optional[Utilization],
+                  shared_thread_pool: bool = False) -> str:
+    # shared_thread_pool: replicas run in one process (ModelPool), so they share its torch thread pools
+    cores = available_cores()
+    lines = [
+        f'Available cores: {format_cores(cores)} ({len(cores)})',
+        f'Replicas: {config.replicas}, core pinning: {"on" if config.pin_cores else "off"}',
+    ]
+    for i, replica_cores in enumerate(core_sets):
+        if shared_thread_pool:
+            lines.append(f'  replica {i}: cores {format_cores(replica_cores)}')
+        else:
+            lines.append(f'  replica {i}: cores {format_cores(replica_cores)}, '
+                         f'intra-op threads {effective_intra_op_threads(config, replica_cores)}')
+    if shared_thread_pool:
+        lines.append(f'Intra-op threads: {effective_intra_op_threads(config, core_sets[0])}, '
+                     f'one torch thread pool shared by all replicas of the process')
+        if config.pin_cores:
+            lines.append('Core pinning applies to the thread processing an upload')
+    lines.append(f'Inter-op threads: {config.inter_op_threads or "default"}')
+    lines.append(f'Decode workers per replica: {config.decode_workers}')
+
+    if utilization is not None:
+        used_cores = sorted({core for replica_cores in core_sets for core in replica_cores})
+        capacity = utilization.wall_seconds * len(used_cores)
+        lines.append(f'Wall time: {utilization.wall_seconds:.1f} s, process CPU time: '
+                     f'{utilization.process_seconds:.1f} s '
+                     f'({utilization.process_seconds / capacity * 100 if capacity > 0 else 0:.0f}% of replica cores)')
+        lines.append('Core utilization: ' + ', '.join(
+            f'{core}: {utilization.per_core[core]:.0f}%' for core in used_cores if core < len(utilization.per_core)))
+
+    return '\n'.join(lines)
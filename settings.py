@@ -17,3 +17,26 @@ YOLO8_IMAGE_SIZE = _settings['yolo8']['image_size']
 YOLO8_DEVICE = _settings['yolo8']['device']
 YOLO8_IOU_THRESHOLD = _settings['yolo8']['iou_threshold']
 YOLO8_CONF_THRESHOLD = _settings['yolo8']['conf_threshold']
+
+YOLO8_ADAPTIVE_SIZE = _settings['yolo8']['adaptive_size']['enabled']
+YOLO8_ADAPTIVE_SIZES = _settings['yolo8']['adaptive_size']['sizes']
+YOLO8_ADAPTIVE_PERSON_SIZE_M = _settings['yolo8']['adaptive_size']['person_size_m']
+YOLO8_ADAPTIVE_PERSON_PIXELS = _settings['yolo8']['adaptive_size']['person_pixels']
+YOLO8_ADAPTIVE_FOCAL_LENGTH_35MM = _settings['yolo8']['adaptive_size']['focal_length_35mm']
+YOLO8_ADAPTIVE_GROUND_ALTITUDE_M = _settings['yolo8']['adaptive_size']['ground_altitude_m']
+
+REVIEW_SCORE = _settings['review']['score']
+REVIEW_PAGE_SIZE = _settings['review']['page_size']
+REVIEW_PREFETCH = _settings['review']['prefetch']
+REVIEW_PREVIEW_SIZE = _settings['review']['preview_size']
+
+SIGHTINGS_DISTANCE_M = _settings['sightings']['distance_m']
+SIGHTINGS_TIME_WINDOW_S = _settings['sightings']['time_window_s']
+
+UPLOAD_MAX_IN_FLIGHT = _settings['upload']['max_in_flight']
+
+RUNTIME_INTRA_OP_THREADS = _settings['runtime']['intra_op_threads']
+RUNTIME_INTER_OP_THREADS = _settings['runtime']['inter_op_threads']
+RUNTIME_REPLICAS = _settings['runtime']['replicas']
+RUNTIME_DECODE_WORKERS = _settings['runtime']['decode_workers']
+RUNTIME_PIN_CORES = _settings['runtime']['pin_cores']
@@ -0,0 +1,96 @@
+﻿import datetime as dt
+from typing import List, Optional
+
+import numpy as np
+from peewee import JOIN, chunked
+
+import storage
+from clustering import Detection, cluster_detections
+
+
+def _detections_query(*columns):
+    # images without EXIF time are placed at the time of their upload
+    return (storage.Label
+            .select(storage.Label.id, storage.Image.id, *columns, storage.Image.latitude, storage.Image.longitude,
+                    storage.Image.timestamp, storage.Upload.timestamp, storage.Label.confidence)
+            .join(storage.Image)
+            .join(storage.Upload)
+            .switch(storage.Label)
+            .where(storage.Image.latitude.is_null(False)))
+
+
+def _to_detection(row, sighting_id: Optional[int]) -> Detection:
+    label_id, image_id, latitude, longitude, image_timestamp, upload_timestamp, confidence = row
+    return Detection(label_id, image_id, sighting_id, latitude, longitude,
+                     image_timestamp or upload_timestamp, confidence)
+
+
+def get_unassigned_detections() -> List[Detection]:
+    query = (_detections_query()
+             .join(storage.SightingLabel, JOIN.LEFT_OUTER, on=(storage.SightingLabel.label == storage.Label.id))
+             .where(storage.SightingLabel.id.is_null()))
+    return [_to_detection(row, None) for row in query.tuples()]
+
+
+def get_sighting_detections(start: dt.datetime, end: dt.datetime) -> List[Detection]:
+    query = (_detections_query(storage.SightingLabel.sighting)
+             .join(storage.SightingLabel, on=(storage.SightingLabel.label == storage.Label.id))
+             .join(storage.Sighting)
+             .where((storage.Sighting.last_seen >= start) & (storage.Sighting.first_seen <= end)))
+    return [_to_detection(row[:2] + row[3:], row[2]) for row in query.tuples()]
+
+
+def _save_sighting(members: List[Detection]):
+    # clusters never merge existing sightings, each one has at most one
+    sighting_id = next((d.sighting_id for d in members if d.sighting_id is not None), None)
+    new_label_ids = [d.label_id for d in members if d.sighting_id is None]
+    if not new_label_ids:
+        return
+
+    best = max(members, key=lambda d: d.confidence)
+    fields = {
+        'image': best.image_id,
+        'latitude': float(np.mean([d.latitude for d in members])),
+        'longitude': float(np.mean([d.longitude for d in members])),
+        'first_seen': min(d.timestamp for d in members),
+        'last_seen': max(d.timestamp for d in members),
+        'confidence': best.confidence,
+        'label_count': len(members),
+    }
+
+    if sighting_id is not None:
+        storage.Sighting.update(**fields).where(storage.Sighting.id == sighting_id).execute()
+    else:
+        sighting_id = storage.Sighting.create(**fields).id
+
+    for batch in chunked(new_label_ids, 100):
+        storage.SightingLabel.insert_many(
+            [{'sighting': sighting_id, 'label': label_id} for label_id in batch]).execute()
+
+
+def update_sightings(distance_m: float, time_window_s: float) -> int:
+    # cheap check without the lock, the map page calls this on every render
+    if not get_unassigned_detections():
+        return 0
+
+    # read, clustering and write in one write transaction, so concurrent sessions
+    # never assign the same labels twice
+    with storage.atomic('IMMEDIATE'):
+        new_detections = get_unassigned_detections()
+        if not new_detections:
+            return 0
+
+        window = dt.timedelta(seconds=time_window_s)
+        start = min(d.timestamp for d in new_detections) - window
+        end = max(d.timestamp for d in new_detections) + window
+        detections = new_detections + get_sighting_detections(start, end)
+
+        clusters = cluster_detections(detections, distance_m, time_window_s)
+
+        order = np.argsort(clusters, kind='stable')
+        boundaries = np.flatnonzero(np.diff(clusters[order])) + 1
+
+        for indices in np.split(order, boundaries):
+            _save_sighting([detections[i] for i in indices])
+
+    return len(new_detections)
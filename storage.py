@@ -1,14 +1,19 @@
 ﻿import datetime as dt
+import shutil
 import uuid
 from pathlib import Path
-from peewee import SqliteDatabase, Model, ForeignKeyField, CharField, DateTimeField, DoubleField
+from typing import BinaryIO, List, Optional, Tuple
+from PIL import Image as PILImage
+from peewee import (SqliteDatabase, Model, ForeignKeyField, CharField, DateTimeField, DoubleField, IntegerField,
+                    SQL, fn)
 
 import settings
 
 
 IMAGES_DIR = settings.STORAGE_DIR / 'images'
+THUMBNAILS_DIR = settings.STORAGE_DIR / 'thumbnails'
+ARCHIVES_DIR = settings.STORAGE_DIR / 'archives'
 DATABASE_PATH = settings.STORAGE_DIR / 'storage.db'
-NEED_INIT_DATABASE = not DATABASE_PATH.exists()
 
 
 DATABASE_PATH.parent.mkdir(exist_ok=True, parents=True)
@@ -53,11 +58,45 @@ class Label(BaseModel):
         return (self.ymax + self.ymin) / 2
 
 
-if NEED_INIT_DATABASE:
-    _database.create_tables([Upload, Image, Label])
+class Sighting(BaseModel):
+    image = ForeignKeyField(Image, backref='sightings')
+    latitude = DoubleField()
+    longitude = DoubleField()
+    first_seen = DateTimeField(index=True)
+    last_seen = DateTimeField(index=True)
+    confidence = DoubleField()
+    label_count = IntegerField()
 
 
-def upload_image(image_data, name: str) -> Path:
+class SightingLabel(BaseModel):
+    sighting = ForeignKeyField(Sighting, backref='members')
+    label = ForeignKeyField(Label, unique=True)
+
+
+class ArchivedImage(BaseModel):
+    image = ForeignKeyField(Image, unique=True, backref='archived')
+    timestamp = DateTimeField()
+    width = IntegerField()
+    height = IntegerField()
+    archive = CharField(null=True)
+
+
+# create_tables() skips existing tables, so new tables are added to old databases too
+_database.create_tables([Upload, Image, Label, Sighting, SightingLabel, ArchivedImage])
+
+
+def atomic(lock_type: Optional[str] = None):
+    # lock_type='IMMEDIATE' takes the write lock before the first read
+    return _database.atomic(lock_type=lock_type)
+
+
+def optimize_database():
+    _database.execute_sql('VACUUM')
+    _database.execute_sql('ANALYZE')
+    _database.execute_sql('REINDEX')
+
+
+def _new_image_path(name: str) -> Path:
     date = dt.datetime.now().strftime('%Y-%m-%d')
     upload_dir = IMAGES_DIR / date
     upload_dir.mkdir(parents=True, exist_ok=True)
@@ -65,7 +104,55 @@ def upload_image(image_data, name: str) -> Path:
     ext = name.rpartition('.')[2]
     filename = uuid.uuid4().hex + '.' + ext
 
-    path = upload_dir / filename
+    return upload_dir / filename
+
+
+def upload_image(image_data, name: str) -> Path:
+    path = _new_image_path(name)
     path.write_bytes(image_data)
 
     return path.relative_to(IMAGES_DIR)
+
+
+def upload_image_file(image_file: BinaryIO, name: str) -> Path:
+    path = _new_image_path(name)
+    with path.open('wb') as output:
+        shutil.copyfileobj(image_file, output)
+
+    return path.relative_to(IMAGES_DIR)
+
+
+def rank_images(upload_id: int, score: str = 'max') -> List[Tuple[int, Optional[float]]]:
+    if score == 'upload':
+        query = Image.select(Image.id, SQL('NULL')).where(Image.upload == upload_id).order_by(Image.id)
+        return list(query.tuples())
+
+    aggregates = {
+        'max': fn.MAX,
+        'sum': fn.SUM,
+    }
+    if score not in aggregates:
+        raise ValueError(f'Unknown image score: {score}')
+
+    query = (Image
+             .select(Image.id, aggregates[score](Label.confidence).alias('score'))
+             .join(Label)
+             .where(Image.upload == upload_id)
+             .group_by(Image.id)
+             .order_by(SQL('score').desc(), Image.id))
+    return list(query.tuples())
+
+
+def thumbnail_path(image_info: Image, label: Label) -> Path:
+    return THUMBNAILS_DIR / Path(image_info.path).with_suffix('') / f'{label.id}.jpg'
+
+
+def open_image(image_info: Image) -> Tuple[PILImage.Image, float]:
+    # returns the stored image and its scale relative to the original, labels are in original coordinates
+    image = PILImage.open(IMAGES_DIR / image_info.path)
+
+    archived = ArchivedImage.get_or_none(ArchivedImage.image == image_info)
+    if archived is None:
+        return image, 1.0
+
+    return image, image.size[0] / archived.width
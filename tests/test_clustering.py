@@ -0,0 +1,72 @@
+import datetime as dt
+import math
+from typing import List
+
+import numpy as np
+import pytest
+
+from clustering import EARTH_RADIUS_M, Detection, cluster_detections
+
+
+START = dt.datetime(2023, 5, 1, 12, 0, 0)
+LATITUDE = 55.75
+LONGITUDE = 37.62
+
+
+def make_detection(label_id: int, image_id: int, east_m: float, seconds: float,
+                   sighting_id=None) -> Detection:
+    longitude = LONGITUDE + math.degrees(east_m / (EARTH_RADIUS_M * math.cos(math.radians(LATITUDE))))
+    return Detection(label_id, image_id, sighting_id, LATITUDE, longitude,
+                     START + dt.timedelta(seconds=seconds), 0.5)
+
+
+def group(clusters: np.ndarray) -> List[List[int]]:
+    return [list(np.flatnonzero(clusters == cluster)) for cluster in np.unique(clusters)]
+
+
+def test_flight_line_does_not_chain():
+    # 60 overlapping frames 20 m apart along a flight line, 2 s between frames
+    detections = [make_detection(i, i, 20.0 * i, 2.0 * i) for i in range(60)]
+
+    clusters = cluster_detections(detections, distance_m=30, time_window_s=300)
+
+    groups = group(clusters)
+    assert len(groups) > 1
+    for members in groups:
+        positions = [20.0 * i for i in members]
+        assert max(positions) - min(positions) <= 30
+
+
+def test_labels_of_one_image_stay_separate():
+    # two people in each of three consecutive frames
+    detections = [make_detection(2 * i + j, i, 5.0 * i, 2.0 * i) for i in range(3) for j in range(2)]
+
+    clusters = cluster_detections(detections, distance_m=30, time_window_s=300)
+
+    groups = group(clusters)
+    assert len(groups) == 2
+    for members in groups:
+        assert len({detections[i].image_id for i in members}) == len(members)
+
+
+def test_existing_sighting_is_kept_and_extended():
+    detections = [
+        make_detection(0, 0, 0.0, 0.0, sighting_id=7),
+        make_detection(1, 1, 10.0, 2.0, sighting_id=7),
+        make_detection(2, 2, 15.0, 4.0),
+        make_detection(3, 3, 500.0, 6.0),
+    ]
+
+    clusters = cluster_detections(detections, distance_m=30, time_window_s=300)
+
+    assert clusters[0] == clusters[1] == clusters[2]
+    assert clusters[3] != clusters[0]
+
+
+@pytest.mark.parametrize('time_window_s', [10, 300])
+def test_time_window(time_window_s):
+    detections = [make_detection(0, 0, 0.0, 0.0), make_detection(1, 1, 0.0, 60.0)]
+
+    clusters = cluster_detections(detections, distance_m=30, time_window_s=time_window_s)
+
+    assert (clusters[0] == clusters[1]) == (time_window_s >= 60)
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from metrics import box_iou, compute_metrics, match_predictions, pareto_optimal
+
+
+MATCH_IOUS = [0.5, 0.75]
+
+
+@pytest.fixture
+def matched():
+    ground_truth = {
+        'a.jpg': np.array([[0, 0, 10, 10], [20, 20, 30, 30]], dtype=float),
+        'b.jpg': np.zeros((0, 4)),
+    }
+    predictions = pd.DataFrame([
+        ('a.jpg', 0.9, 0, 0, 10, 10),  # exact match of the first box
+        ('a.jpg', 0.8, 0, 0, 10, 10),  # duplicate, the first box is already matched
+        ('a.jpg', 0.7, 20, 20, 30, 35),  # IoU 2/3 with the second box
+        ('b.jpg', 0.6, 0, 0, 5, 5),  # no ground truth in the image
+    ], columns=['image', 'score', 'xmin', 'ymin', 'xmax', 'ymax'])
+    return match_predictions(predictions, ground_truth, MATCH_IOUS)
+
+
+def test_box_iou():
+    ious = box_iou(np.array([[20, 20, 30, 35]], dtype=float), np.array([[20, 20, 30, 30]], dtype=float))
+    assert ious[0, 0] == pytest.approx(2 / 3)
+
+
+def test_match_predictions(matched):
+    assert matched.ground_truth_count == 2
+    order = np.argsort(-matched.scores)
+    assert matched.true_positives[0][order].tolist() == [True, False, True, False]
+    assert matched.true_positives[1][order].tolist() == [True, False, False, False]
+
+
+def test_compute_metrics(matched):
+    precision, recall, average_precision = compute_metrics(matched, 0.0)
+
+    assert precision.tolist() == pytest.approx([2 / 4, 1 / 4])
+    assert recall.tolist() == pytest.approx([1.0, 0.5])
+    # 101 recall points: 0..0.5 at precision 1, 0.51..1 at the interpolated precision 2/3;
+    # recall above 0.5 is never reached at IoU 0.75
+    assert average_precision.tolist() == pytest.approx([(51 + 50 * 2 / 3) / 101, 51 / 101])
+
+
+def test_compute_metrics_confidence(matched):
+    precision, recall, _ = compute_metrics(matched, 0.75)
+
+    assert precision.tolist() == pytest.approx([1 / 2, 1 / 2])
+    assert recall.tolist() == pytest.approx([0.5, 0.5])
+
+
+def test_pareto_optimal():
+    recall = np.array([0.9, 0.8, 0.7, 0.9])
+    speed = np.array([1.0, 2.0, 1.5, 0.5])
+    assert pareto_optimal(recall, speed).tolist() == [True, True, False, False]
@@ -1,29 +1,41 @@
-﻿import platform
+﻿import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional
+
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 
 import storage
 import utils
 
 
-def show_detection_results(image_info: storage.Image):
-    image = Image.open(storage.IMAGES_DIR / image_info.path)
+class DetectionResults(NamedTuple):
+    image_info: storage.Image
+    image: Image.Image
+    patches: List[Image.Image]
+
+
+def render_detection_results(image_info: storage.Image, max_size: Optional[int] = None) -> DetectionResults:
+    image, scale = storage.open_image(image_info)
+    labels = list(image_info.labels)
+
+    font = utils.load_font(15)
 
     patches = []
-    for label in image_info.labels:
+    for label in labels:
         patch_size = 200
-        patch = image.crop((label.xc - patch_size / 2,
-                            label.yc - patch_size / 2,
-                            label.xc + patch_size / 2,
-                            label.yc + patch_size / 2))
+        thumbnail_path = storage.thumbnail_path(image_info, label)
+        if scale == 1.0:
+            patch = utils.crop_patch(image, label.xc, label.yc, patch_size)
+        elif thumbnail_path.exists():
+            patch = Image.open(thumbnail_path)
+        else:
+            patch = utils.crop_patch(image, label.xc * scale, label.yc * scale, patch_size * scale)
+            patch = patch.resize((patch_size, patch_size))
 
         draw = ImageDraw.Draw(patch, 'RGBA')
 
-        if platform.system() == 'Windows':
-            font = ImageFont.truetype('arial.ttf', 15)
-        else:
-            font = ImageFont.truetype('DejaVuSans.ttf', 15)
-
         text = f'{label.confidence:.2f}'
         bbox = draw.textbbox((patch_size - 3, patch_size - 3), text, font=font, anchor='rb')
         draw.rectangle((bbox[0] - 3, bbox[1] - 3, bbox[2] + 3, bbox[3] + 3), fill=(30,30,30,125))
@@ -32,8 +44,18 @@ def show_detection_results(image_info: storage.Image):
         patches.append(patch)
 
     draw = ImageDraw.Draw(image)
-    for label in image_info.labels:
-        draw.rectangle(((label.xmin, label.ymin), (label.xmax, label.ymax)), width=3, outline='red')
+    for label in labels:
+        draw.rectangle(((label.xmin * scale, label.ymin * scale), (label.xmax * scale, label.ymax * scale)),
+                       width=3, outline='red')
+
+    if max_size is not None:
+        image.thumbnail((max_size, max_size))
+
+    return DetectionResults(image_info, image, patches)
+
+
+def show_rendered_results(results: DetectionResults):
+    image_info = results.image_info
 
     st.subheader(image_info.original_name)
 
@@ -42,13 +64,53 @@ def show_detection_results(image_info: storage.Image):
         lon_dms = utils.deg_to_dms(image_info.longitude, 'lon')
         st.write(f'Координаты: [{lat_dms} {lon_dms}](https://www.google.com/maps/place/{image_info.latitude},{image_info.longitude})')
 
-    st.image(image)
+    st.image(results.image)
 
-    if len(image_info.labels) == 0:
+    if len(results.patches) == 0:
         st.write('Люди не обнаружены')
     else:
-        st.write(f'Обнаружено людей: {len(image_info.labels)}')
+        st.write(f'Обнаружено людей: {len(results.patches)}')
         columns = st.columns(3)
-        for i, (label, patch) in enumerate(zip(image_info.labels, patches)):
+        for i, patch in enumerate(results.patches):
             with columns[i % 3]:
                 st.image(patch)
+
+
+def show_detection_results(image_info: storage.Image):
+    show_rendered_results(render_detection_results(image_info))
+
+
+class PreviewPrefetcher:
+
+    # one prefetcher per session, so operators reviewing concurrently don't evict each other's previews;
+    # the executor rendering them is shared
+    def __init__(self, executor: ThreadPoolExecutor, max_size: Optional[int], max_entries: int):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._executor = executor
+        self._futures: 'OrderedDict[int, Future[DetectionResults]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, image_ids: Iterable[int]):
+        for image_id in image_ids:
+            self._submit(image_id)
+
+    def get(self, image_id: int) -> DetectionResults:
+        return self._submit(image_id).result()
+
+    def _submit(self, image_id: int) -> 'Future[DetectionResults]':
+        with self._lock:
+            future = self._futures.get(image_id)
+            if future is None:
+                future = self._executor.submit(self._render, image_id)
+                self._futures[image_id] = future
+            self._futures.move_to_end(image_id)
+
+            while len(self._futures) > self.max_entries:
+                self._futures.popitem(last=False)
+
+            return future
+
+    def _render(self, image_id: int) -> DetectionResults:
+        image_info = storage.Image.get_by_id(image_id)
+        return render_detection_results(image_info, self.max_size)
@@ -1,15 +1,25 @@
-﻿import ctypes
+﻿import collections
+import ctypes
 import datetime as dt
 import math
 import platform
+import re
 import time
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+import cv2
+import numpy as np
+from PIL import ImageFont
 from PIL.ExifTags import TAGS, GPSTAGS
 
 
 IMAGE_EXTENSIONS = ['jpg', 'png']
 
+T = TypeVar('T')
+R = TypeVar('R')
+
 
 def get_exif(image):
     exif_data = {}
@@ -29,6 +39,16 @@ def get_exif(image):
     return exif_data
 
 
+def crop_patch(image, xc: float, yc: float, size: float):
+    return image.crop((xc - size / 2, yc - size / 2, xc + size / 2, yc + size / 2))
+
+
+def load_font(size: int):
+    if platform.system() == 'Windows':
+        return ImageFont.truetype('arial.ttf', size)
+    return ImageFont.truetype('DejaVuSans.ttf', size)
+
+
 def decimal_coords(coords, ref):
     decimal_degrees = coords[0] + coords[1] / 60 + coords[2] / 3600
     if ref == 'S' or ref == 'W':
@@ -46,6 +66,38 @@ def get_gps_coordinates(image):
     return None, None
 
 
+def get_altitude(image) -> Optional[float]:
+    exif = get_exif(image)
+    gps_info = exif.get('GPSInfo', {})
+    if 'GPSAltitude' not in gps_info:
+        return None
+
+    altitude = float(gps_info['GPSAltitude'])
+    if gps_info.get('GPSAltitudeRef') in (1, b'\x01'):
+        altitude = -altitude
+    return altitude
+
+
+def get_relative_altitude(image) -> Optional[float]:
+    # altitude above the takeoff point, written to XMP by DJI drones
+    xmp = image.info.get('xmp')
+    if not xmp:
+        return None
+
+    if isinstance(xmp, bytes):
+        xmp = xmp.decode('utf-8', errors='ignore')
+    # attribute form RelativeAltitude="+50.2" or element form <drone-dji:RelativeAltitude>+50.2</...>
+    match = re.search(r'RelativeAltitude\s*(?:=\s*"?|>)\s*([+-]?[0-9.]+)', xmp)
+    return float(match.group(1)) if match else None
+
+
+def get_focal_length_35mm(image) -> Optional[float]:
+    exif = get_exif(image)
+    if exif.get('FocalLengthIn35mmFilm'):
+        return float(exif['FocalLengthIn35mmFilm'])
+    return None
+
+
 def get_datetime_original(image):
     exif = get_exif(image)
     if 'DateTimeOriginal' in exif:
@@ -85,6 +137,14 @@ def enum_images(root: Path) -> Iterable[Path]:
             yield path
 
 
+def read_image(path: Path, ignore_orientation: bool = True) -> np.ndarray:
+    # BGR image as expected by YOLO; by default EXIF orientation is ignored to keep the PIL coordinates,
+    # otherwise it is applied like cv2.imread() does when ultralytics reads a path
+    data = np.fromfile(path, dtype=np.uint8)
+    flags = cv2.IMREAD_COLOR | (cv2.IMREAD_IGNORE_ORIENTATION if ignore_orientation else 0)
+    return cv2.imdecode(data, flags)
+
+
 def set_console_title(title: str):
     if platform.system() == 'Windows':
         ctypes.windll.kernel32.SetConsoleTitleW(title)
@@ -97,3 +157,15 @@ def remaining_time(stopwatch: Stopwatch, done: int, total: int, seconds_rounding
     assert done <= total
     remaining_seconds = stopwatch.elapsed().total_seconds() / done * (total - done)
     return dt.timedelta(seconds=seconds_rounding(remaining_seconds))
+
+
+def bounded_map(executor: Executor, func: Callable[[T], R], items: Iterable[T], max_in_flight: int) -> Iterator[R]:
+    # like Executor.map(), but never submits more than max_in_flight items ahead of the consumer
+    pending: collections.deque = collections.deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+
+    while pending:
+        yield pending.popleft().result()